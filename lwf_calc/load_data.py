@@ -1,4 +1,6 @@
 import xarray as xr
+import numpy as np
+import functools
 import os
 from datetime import datetime
 
@@ -6,6 +8,9 @@ def load_SNODAS(start_date, end_date, variable='SWE', lat=None, lon=None):
     """
     Load SNODAS data for a specific date range and location.
     
+    Data is read from the Zarr archive (Archive/SNODAS_<variable>.zarr) when it
+    exists, otherwise from the daily *_final.nc files in the Archive directory.
+    
     Parameters:
     -----------
     start_date : str or datetime
@@ -14,15 +19,16 @@ def load_SNODAS(start_date, end_date, variable='SWE', lat=None, lon=None):
         End date in format 'YYYY-MM-DD' or datetime object
     variable : str
         Either 'SWE' or 'SD' (Snow Water Equivalent or Snow Depth)
-    lat : float, optional
-        Latitude of interest. If None, returns all latitudes
-    lon : float, optional
-        Longitude of interest. If None, returns all longitudes
+    lat : float or array-like, optional
+        Latitude(s) of interest. If None, returns all latitudes
+    lon : float or array-like, optional
+        Longitude(s) of interest. If None, returns all longitudes. Arrays of
+        lat/lon pairs are selected together along a new 'site' dimension
     
     Returns:
     --------
     xarray.Dataset
-        Dataset containing the requested SNODAS data
+        Dataset containing the requested SNODAS data (lazily loaded with dask)
     """
     # Convert string dates to datetime if needed
     if isinstance(start_date, str):
@@ -30,39 +36,106 @@ def load_SNODAS(start_date, end_date, variable='SWE', lat=None, lon=None):
     if isinstance(end_date, str):
         end_date = datetime.strptime(end_date, '%Y-%m-%d')
     
-    # Get list of files in Archive directory
     archive_dir = os.path.join(os.path.dirname(__file__), "Archive")
-    files = [f for f in os.listdir(archive_dir) if f.endswith(f"{variable}_final.nc")]
+    store_path = os.path.join(archive_dir, f"SNODAS_{variable}.zarr")
+    
+    if os.path.exists(store_path):
+        # Read only the chunks covering the date range from the Zarr archive
+        combined_data = xr.open_zarr(store_path, consolidated=True)
+        combined_data = combined_data.sel(time=slice(start_date, end_date))
+        if combined_data.sizes['time'] == 0:
+            raise ValueError(f"No {variable} data found for the specified date range")
+        # Zarr keeps attributes as JSON, so the float32 scale_factor of the SD
+        # store is read back as a Python float and decoded to float64
+        combined_data[variable] = combined_data[variable].astype(np.float32, copy=False)
+    else:
+        combined_data = _load_SNODAS_netcdf(archive_dir, start_date, end_date, variable)
+    
+    # Select specific location(s) if provided
+    if lat is not None and lon is not None:
+        combined_data = _select_sites(combined_data, lat, lon)
     
-    # Filter files for date range
-    date_files = []
-    for file in files:
-        # Extract date from filename (assuming format contains YYYYMMDD)
-        date_str = file.split('_')[0]  # Adjust this based on your filename format
-        file_date = datetime.strptime(date_str, '%Y%m%d')
-        if start_date <= file_date <= end_date:
-            date_files.append(file)
+    return combined_data
+
+def _select_sites(ds, lat, lon, lat_name='lat', lon_name='lon'):
+    """
+    Nearest-neighbour selection of one location, or of several lat/lon pairs at
+    once along a 'site' dimension (vectorized pointwise indexing).
+    """
+    if np.ndim(lat) == 0 and np.ndim(lon) == 0:
+        return ds.sel({lat_name: lat, lon_name: lon}, method='nearest')
+    return ds.sel(
+        {
+            lat_name: xr.DataArray(np.asarray(lat), dims='site'),
+            lon_name: xr.DataArray(np.asarray(lon), dims='site')
+        },
+        method='nearest'
+    )
+
+@functools.lru_cache(maxsize=None)
+def _file_index(archive_dir, variable):
+    """
+    Scan the legacy archive once per process and return a sorted datetime64[D]
+    array of file dates with the matching list of file paths.
+    """
+    with os.scandir(archive_dir) as it:
+        entries = sorted(
+            (entry.name, entry.path) for entry in it
+            if entry.name.endswith(f"{variable}_final.nc")
+        )
+    
+    # Filenames start with the date (YYYYMMDD_<variable>_final.nc), so sorting by
+    # name sorts by date. Parse all dates at once as ISO strings
+    dates = np.array(
+        [f"{name[:4]}-{name[4:6]}-{name[6:8]}" for name, _ in entries],
+        dtype='datetime64[D]'
+    )
+    paths = [path for _, path in entries]
+    return dates, paths
+
+def _load_SNODAS_netcdf(archive_dir, start_date, end_date, variable):
+    """
+    Load SNODAS data from the legacy archive of daily *_final.nc files.
+    """
+    # Binary search the cached file index for the date range
+    dates, paths = _file_index(archive_dir, variable)
+    i0 = np.searchsorted(dates, np.datetime64(start_date, 'D'), side='left')
+    i1 = np.searchsorted(dates, np.datetime64(end_date, 'D'), side='right')
+    date_files = paths[i0:i1]
     
     if not date_files:
         raise ValueError(f"No {variable} files found for the specified date range")
     
-    # Sort files by date
-    date_files.sort()
-    
-    # Load and concatenate data
-    data_list = []
-    for file in date_files:
-        ds = xr.open_dataset(os.path.join(archive_dir, file))
-        data_list.append(ds)
-    
-    # Concatenate all data
-    combined_data = xr.concat(data_list, dim='time')
-    
-    # Select specific location if provided
-    if lat is not None and lon is not None:
-        combined_data = combined_data.sel(lat=lat, lon=lon, method='nearest')
+    # Open all files lazily and combine them along their time coordinates without
+    # copying any data (one dask chunk per day), so only the data actually
+    # selected by the caller is read from disk. The lat/lon grid is the same in
+    # every file, so it is taken from the first one instead of being compared
+    return xr.open_mfdataset(
+        date_files,
+        combine='by_coords',
+        data_vars='minimal',
+        coords='minimal',
+        compat='override',
+        combine_attrs='override',
+        parallel=True,
+        chunks={'time': 1},
+        engine='h5netcdf'
+    )
+
+@functools.lru_cache(maxsize=4)
+def _open_CaPA(archive_dir):
+    """
+    Open the concatenated CaPA archive lazily. The result is cached, so the
+    directory listing and the file header are only read once per process.
+    A Zarr store in the archive directory is preferred over a NetCDF file.
+    """
+    zarr_store = sorted(f for f in os.listdir(archive_dir) if f.endswith(".zarr"))
+    if zarr_store:
+        return xr.open_zarr(os.path.join(archive_dir, zarr_store[0]), consolidated=True)
     
-    return combined_data
+    nc_file = sorted(f for f in os.listdir(archive_dir) if f.endswith(".nc"))
+    capa_file = os.path.join(archive_dir, nc_file[0])
+    return xr.open_dataset(capa_file, chunks={'time': 365}, engine='h5netcdf')
 
 def load_CaPA(start_date, end_date, lat=None, lon=None):
     """
@@ -74,10 +147,11 @@ def load_CaPA(start_date, end_date, lat=None, lon=None):
         Start date in format 'YYYY-MM-DD' or datetime object
     end_date : str or datetime
         End date in format 'YYYY-MM-DD' or datetime object
-    lat : float, optional
-        Latitude of interest. If None, returns all latitudes
-    lon : float, optional
-        Longitude of interest. If None, returns all longitudes
+    lat : float or array-like, optional
+        Latitude(s) of interest. If None, returns all latitudes
+    lon : float or array-like, optional
+        Longitude(s) of interest. If None, returns all longitudes. Arrays of
+        lat/lon pairs are selected together along a new 'site' dimension
     
     Returns:
     --------
@@ -90,19 +164,15 @@ def load_CaPA(start_date, end_date, lat=None, lon=None):
     if isinstance(end_date, str):
         end_date = datetime.strptime(end_date, '%Y-%m-%d')
     
-    # Load the concatenated CaPA file
+    # Load the concatenated CaPA dataset (opened once per process)
     archive_dir = os.path.join(os.path.dirname(__file__), "Archive_CaPA")
-    nc_file = [f for f in os.listdir(archive_dir) if f.endswith(".nc")]
-    capa_file = os.path.join(archive_dir, nc_file[0])
-    
-    # Load the dataset
-    ds = xr.open_dataset(capa_file)
+    ds = _open_CaPA(archive_dir)
     
     # Select the date range
     data = ds.sel(time=slice(start_date, end_date))
     
-    # Select specific location if provided
+    # Select specific location(s) if provided (CaPA uses latitude/longitude)
     if lat is not None and lon is not None:
-        data = data.sel(lat=lat, lon=lon, method='nearest')
+        data = _select_sites(data, lat, lon, lat_name='latitude', lon_name='longitude')
     
     return data
\ No newline at end of file
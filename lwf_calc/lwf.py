@@ -1,57 +1,85 @@
 import xarray as xr
 import pandas as pd
 import numpy as np
+import os
+
+from .lwf_kernel import lwf_gufunc, get_lwf_gufunc_parallel
 
 # Calculate Liquid Water Flux (LWF) using the formula: LWF(t) = SWE(t-1) - SWE(t) + P(t)
 # Where SWE is from SNODAS and P is from CaPA
 
+def _lwf_numpy(swe, precip):
+    """
+    NumPy version of the LWF gufunc (used without numba): LWF in m/s and mm/day
+    along the last (time) axis, with NaN for the first time step.
+    """
+    lwf_mm_day = np.full(swe.shape, np.nan, dtype=np.result_type(swe, precip))
+    np.subtract(swe[..., :-1], swe[..., 1:], out=lwf_mm_day[..., 1:])
+    lwf_mm_day[..., 1:] += precip[..., 1:]
+
+    # Convert negative values to zero (in place, NaNs are kept)
+    np.maximum(lwf_mm_day, 0, out=lwf_mm_day)
+
+    # convert to m/sec
+    lwf_m_s = lwf_mm_day / (86400 * 1000)
+    return lwf_m_s, lwf_mm_day
+
+def _lwf_gufunc(swe, precip, parallel=False):
+    """
+    Call the numba LWF gufunc; the multi-threaded one for in-memory arrays.
+    NaN cells set the invalid floating point flag, which is not an error here.
+    """
+    kernel = get_lwf_gufunc_parallel() if parallel else lwf_gufunc
+    with np.errstate(invalid='ignore'):
+        return kernel(swe, precip)
+
 def calculate_lwf(SNODAS_SWE, CaPA):
 
     # Extract the SWE data from upscaled SNODAS
     swe = SNODAS_SWE.swe_upscaled
 
-    # Extract precipitation data from CaPA
-    precip = CaPA.accum_precip
-
-    # Create a new dataset with the same dimensions as the input datasets
-    lwf_data = xr.DataArray(
-        data=np.zeros((len(swe.time)-1, len(swe.latitude), len(swe.longitude))),
-        dims=["time", "latitude", "longitude"],
-        coords={
-            "time": swe.time[1:],  # Start from the second day
-            "latitude": swe.latitude,
-            "longitude": swe.longitude
-        }
+    # Extract precipitation data from CaPA, aligned to the SWE time axis
+    precip = CaPA.accum_precip.reindex(time=swe.time).transpose(*swe.dims)
+
+    lazy = swe.chunks is not None or precip.chunks is not None
+    if lazy:
+        # LWF(t) couples consecutive days, so the whole time axis goes in one chunk.
+        # A grid is split into one band of latitudes per CPU, computed in parallel
+        chunks = {'time': -1}
+        if 'latitude' in swe.dims:
+            chunks['latitude'] = -(-swe.sizes['latitude'] // (os.cpu_count() or 1))
+        swe = swe.chunk(chunks)
+        precip = precip.chunk(chunks)
+
+    # Calculate LWF in m/s and mm/day for all time steps at once with the numba
+    # gufunc (one fused pass over each time series):
+    # LWF(t) = SWE(t-1) - SWE(t) + P(t)
+    # Dask-backed inputs stay lazy until the result is written or computed
+    if lwf_gufunc is None:
+        kernel, kwargs = _lwf_numpy, {}
+    else:
+        kernel, kwargs = _lwf_gufunc, {'parallel': not lazy}
+
+    dtype = np.result_type(swe.dtype, precip.dtype)
+    lwf_m_s, lwf_mm_day = xr.apply_ufunc(
+        kernel,
+        swe,
+        precip,
+        input_core_dims=[['time'], ['time']],
+        output_core_dims=[['time'], ['time']],
+        kwargs=kwargs,
+        dask='parallelized',
+        output_dtypes=[dtype, dtype]
     )
 
-    # Calculate LWF for each time step (starting from the second day)
-    for t in range(1, len(swe.time)):
-        current_date = swe.time[t].values
-        previous_date = swe.time[t-1].values
-        
-        # Get SWE for current and previous day
-        swe_current = swe.sel(time=current_date)
-        swe_previous = swe.sel(time=previous_date)
-        
-        # Get precipitation for current day
-        precip_current = precip.sel(time=current_date)
-        
-        # Calculate LWF: LWF(t) = SWE(t-1) - SWE(t) + P(t)
-        lwf = swe_previous - swe_current + precip_current
-        
-        # Convert negative values to zero
-        lwf = xr.where(lwf < 0, 0, lwf)
-
-        # convert to m/sec
-        lwf = lwf / (86400 * 1000)
-        
-        # Add to the data array
-        lwf_data[t-1, :, :] = lwf
+    # Start from the second day and restore the (time, lat, lon) order
+    lwf_m_s = lwf_m_s.isel(time=slice(1, None)).transpose("time", ...)
+    lwf_mm_day = lwf_mm_day.isel(time=slice(1, None)).transpose("time", ...)
 
     # Create the final dataset
     lwf_dataset = xr.Dataset(
         data_vars={
-            "lwf": lwf_data
+            "lwf": lwf_m_s
         },
         attrs={
             "description": "Liquid Water Flux calculated as LWF(t) = SWE(t-1) - SWE(t) + P(t)",
@@ -62,7 +90,7 @@ def calculate_lwf(SNODAS_SWE, CaPA):
 
     lwf_dataset_mm_day = xr.Dataset(
         data_vars={
-            "lwf": lwf_data * 86400 * 1000
+            "lwf": lwf_mm_day
         },
         attrs={
             "description": "Liquid Water Flux calculated as LWF(t) = SWE(t-1) - SWE(t) + P(t)",
@@ -0,0 +1,53 @@
+# Numba gufunc kernels for the Liquid Water Flux (LWF) calculation
+
+import numpy as np
+
+# Numba is optional; without it the kernels are None and lwf.py uses NumPy
+try:
+    from numba import guvectorize, float32, float64
+except ImportError:
+    guvectorize = None
+
+def _lwf_series(swe, precip, lwf_m_s, lwf_mm_day):
+    """
+    LWF(t) = max(SWE(t-1) - SWE(t) + P(t), 0) of one time series, written in m/s
+    and in mm/day in a single pass. The first time step has no previous day and
+    is set to NaN. NaN inputs propagate to the output.
+    """
+    lwf_m_s[0] = np.nan
+    lwf_mm_day[0] = np.nan
+    for t in range(1, swe.shape[0]):
+        v = swe[t - 1] - swe[t] + precip[t]
+        if v < 0:
+            v = 0.0
+        lwf_mm_day[t] = v
+        lwf_m_s[t] = v / (86400.0 * 1000.0)
+
+if guvectorize is not None:
+    _SIGNATURES = [
+        (float32[:], float32[:], float32[:], float32[:]),
+        (float64[:], float64[:], float64[:], float64[:]),
+    ]
+    _LAYOUT = '(t),(t)->(t),(t)'
+
+    # Single-threaded version for dask blocks, since dask already runs several
+    # blocks at once
+    lwf_gufunc = guvectorize(_SIGNATURES, _LAYOUT, nopython=True, cache=True)(_lwf_series)
+else:
+    lwf_gufunc = None
+
+_lwf_gufunc_parallel = None
+
+def get_lwf_gufunc_parallel():
+    """
+    Multi-threaded version of lwf_gufunc for in-memory arrays, compiled on first
+    use. Compiling it starts numba's threading layer, and with the TBB layer a
+    process that has done so and then forks (e.g. a ProcessPoolExecutor) hangs
+    at exit, so this is not done when lwf_calc is imported.
+    """
+    global _lwf_gufunc_parallel
+    if _lwf_gufunc_parallel is None and guvectorize is not None:
+        _lwf_gufunc_parallel = guvectorize(
+            _SIGNATURES, _LAYOUT, target='parallel', nopython=True, cache=True
+        )(_lwf_series)
+    return _lwf_gufunc_parallel
@@ -1,10 +1,91 @@
 # Resampling SNODAS to CaPA grid
 
+import os
+import hashlib
 import numpy as np
-from scipy.interpolate import griddata
 import xarray as xr
 
-def resample_SNODAS_to_CaPA(SNODAS_SWE, CaPA):
+# CuPy is optional; set LWF_RESAMPLE_GPU=1 to interpolate on a CUDA GPU when it
+# is installed. The NumPy path is the default
+try:
+    import cupy as cp
+    from cupyx.scipy import ndimage as cp_ndimage
+except ImportError:
+    cp = None
+
+USE_GPU = cp is not None and os.environ.get('LWF_RESAMPLE_GPU', '0') == '1'
+
+def _coord_slice(coord, vmin, vmax):
+    """
+    Index slice selecting the values of a sorted 1-D coordinate that lie within
+    [vmin, vmax], found with a binary search instead of a full boolean mask.
+    """
+    if coord[0] > coord[-1]:
+        # Descending coordinate: search the reversed array and map back
+        i0 = np.searchsorted(coord[::-1], vmin, side='left')
+        i1 = np.searchsorted(coord[::-1], vmax, side='right')
+        return slice(len(coord) - i1, len(coord) - i0)
+
+    i0 = np.searchsorted(coord, vmin, side='left')
+    i1 = np.searchsorted(coord, vmax, side='right')
+    return slice(i0, i1)
+
+def _linear_weights(src, dst):
+    """
+    Lower neighbour index and weight of every dst value for linear interpolation
+    along the sorted 1-D coordinate src. Values outside src get a NaN weight.
+    """
+    if src[0] > src[-1]:
+        # Descending coordinate: interpolate along the reversed array and map
+        # the neighbours back (lower index n-2-i0 gets the weight 1-w)
+        i0, w = _linear_weights(src[::-1], dst)
+        return len(src) - 2 - i0, 1 - w
+
+    i0 = np.clip(np.searchsorted(src, dst, side='right') - 1, 0, len(src) - 2)
+    w = ((dst - src[i0]) / (src[i0 + 1] - src[i0])).astype(np.float32)
+    w[(dst < src[0]) | (dst > src[-1])] = np.nan
+    return i0, w
+
+# Interpolation weights already computed in this process, by grid hash
+_WEIGHTS_CACHE = {}
+
+def _resample_weights(snodas_lat, snodas_lon, capa_lat, capa_lon, cache_dir=None):
+    """
+    Neighbour indices and weights of the bilinear interpolation from the SNODAS
+    grid to the CaPA grid. They are kept in memory for later calls in the same
+    process and read from / saved to cache_dir when it is given. The cache key
+    is a hash of the four grid coordinates.
+    """
+    # The version tag invalidates weights cached before descending coordinates
+    # were supported (they were all NaN)
+    digest = hashlib.sha1(b'v2')
+    for coord in (snodas_lat, snodas_lon, capa_lat, capa_lon):
+        digest.update(np.ascontiguousarray(coord, dtype=np.float64).tobytes())
+    key = digest.hexdigest()
+
+    if key in _WEIGHTS_CACHE:
+        return _WEIGHTS_CACHE[key]
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, f"resample_weights_{key}.npz")
+
+    if cache_file is not None and os.path.exists(cache_file):
+        with np.load(cache_file) as cached:
+            weights = (cached['lat_i0'], cached['lat_w'], cached['lon_i0'], cached['lon_w'])
+    else:
+        lat_i0, lat_w = _linear_weights(snodas_lat, capa_lat)
+        lon_i0, lon_w = _linear_weights(snodas_lon, capa_lon)
+        weights = (lat_i0, lat_w, lon_i0, lon_w)
+
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.savez(cache_file, lat_i0=lat_i0, lat_w=lat_w, lon_i0=lon_i0, lon_w=lon_w)
+
+    _WEIGHTS_CACHE[key] = weights
+    return weights
+
+def resample_SNODAS_to_CaPA(SNODAS_SWE, CaPA, cache_dir=None):
 
     """
     Resample SNODAS SWE data to CaPA grid resolution using linear interpolation.
@@ -15,6 +96,9 @@ def resample_SNODAS_to_CaPA(SNODAS_SWE, CaPA):
         Path to SNODAS SWE NetCDF file or loaded xarray Dataset containing SWE data
     CaPA : str or xarray.Dataset
         Path to CaPA NetCDF file or loaded xarray Dataset containing precipitation data
+    cache_dir : str or Path, optional
+        Directory where the interpolation weights are cached between runs. If None,
+        the weights are computed on every call
     
     Returns:
     --------
@@ -27,10 +111,14 @@ def resample_SNODAS_to_CaPA(SNODAS_SWE, CaPA):
     
     Notes:
     ------
-    - SNODAS data is upscaled to CaPA grid resolution using linear interpolation
+    - SNODAS data is upscaled to CaPA grid resolution using bilinear interpolation
+      on the regular SNODAS lat/lon grid
     - CaPA grid is cropped to match SNODAS spatial extent
     - NaN values in SNODAS data are excluded from interpolation
     - Output maintains the same time dimension as input SNODAS data
+    - Time steps are interpolated in parallel with dask; the result is returned
+      lazily and only computed when it is used or written
+    - With LWF_RESAMPLE_GPU=1 and CuPy installed the interpolation runs on the GPU
     """
 
     # Load the datasets
@@ -41,59 +129,96 @@ def resample_SNODAS_to_CaPA(SNODAS_SWE, CaPA):
     SNODAS_lon_range = SNODAS_SWE['lon'].values
 
     # Cut CaPA to the same extent as SNODAS
-    CaPA = CaPA.where((CaPA['longitude'] >= SNODAS_lon_range[0]) & 
-                              (CaPA['longitude'] <= SNODAS_lon_range[-1]) &
-                              (CaPA['latitude'] >= SNODAS_lat_range[0]) &
-                              (CaPA['latitude'] <= SNODAS_lat_range[-1]), drop=True)
+    CaPA = CaPA.isel(
+        latitude=_coord_slice(CaPA['latitude'].values, SNODAS_lat_range.min(), SNODAS_lat_range.max()),
+        longitude=_coord_slice(CaPA['longitude'].values, SNODAS_lon_range.min(), SNODAS_lon_range.max())
+    )
 
     # Get the CaPA grid
     CaPA_lat_range = CaPA['latitude'].values
     CaPA_lon_range = CaPA['longitude'].values
 
 
-    # Initialize an empty array for upscaled SWE with CaPA dimensions
-    time_dim = len(SNODAS_SWE['time'])
-    upscaled_swe = np.zeros((time_dim, len(CaPA_lat_range), len(CaPA_lon_range)))
-
-
-    snodas_lon, snodas_lat = np.meshgrid(SNODAS_lon_range, SNODAS_lat_range)
-    capa_lon, capa_lat = np.meshgrid(CaPA_lon_range, CaPA_lat_range)
-
-
-    for t in range(time_dim):
-        swe_values = SNODAS_SWE['SWE'].isel(time=t).values
-    
-        # Flatten coordinates and values for interpolation
-        points = np.column_stack((snodas_lat.flatten(), snodas_lon.flatten()))
-        values = swe_values.flatten()
-    
-        # Remove any NaN values
-        valid_indices = ~np.isnan(values)
-        valid_points = points[valid_indices]
-        valid_values = values[valid_indices]
-    
-        # Perform interpolation to CaPA grid (using 'linear' method for upscaling)
-        upscaled_values = griddata(
-        valid_points, 
-        valid_values, 
-        (capa_lat, capa_lon), 
-        method='linear'
-        )
-    
-        # Store the upscaled values
-        upscaled_swe[t] = upscaled_values
-
-    upscaled_swe_da = xr.DataArray(
-        data=upscaled_swe,
-        dims=['time', 'latitude', 'longitude'],
-        coords={
-            'time': SNODAS_SWE['time'],
-            'latitude': CaPA_lat_range,
-            'longitude': CaPA_lon_range
-        },
-        name='swe_upscaled'
+    # Bilinear interpolation onto the (separable) CaPA grid: the neighbour indices
+    # and weights are identical for every time step (and every run on the same grids)
+    lat_i0, lat_w, lon_i0, lon_w = _resample_weights(
+        SNODAS_lat_range, SNODAS_lon_range, CaPA_lat_range, CaPA_lon_range, cache_dir
+    )
+    lat_rows = np.stack([lat_i0, lat_i0 + 1])
+    lat_weights = np.stack([1 - lat_w, lat_w])[:, :, None]
+    out_shape = (len(CaPA_lat_range), len(CaPA_lon_range))
+
+    def _interp_block(swe_block):
+        # swe_block has shape (time, lat, lon) for one dask chunk
+        upscaled_block = np.empty(swe_block.shape[:-2] + out_shape, dtype=np.float32)
+
+        for t in range(swe_block.shape[0]):
+            # Only the SNODAS rows around the CaPA latitudes are needed
+            rows = swe_block[t][lat_rows]
+
+            # Exclude NaN values from the interpolation: interpolate the zero-filled
+            # values together with the valid-data mask, then normalize by the mask
+            valid = ~np.isnan(rows)
+            stacked = np.stack([np.where(valid, rows, np.float32(0)), valid.astype(np.float32)])
+
+            # Interpolate along latitude, then along longitude
+            stacked = (stacked * lat_weights).sum(axis=1)
+            stacked = stacked[:, :, lon_i0] * (1 - lon_w) + stacked[:, :, lon_i0 + 1] * lon_w
+            weighted_sum, weight = stacked
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                np.divide(weighted_sum, weight, out=upscaled_block[t])
+            upscaled_block[t][~(weight > 0)] = np.nan
+
+        return upscaled_block
+
+    if USE_GPU:
+        # Fractional SNODAS indices of the CaPA grid points for map_coordinates.
+        # Points outside SNODAS are moved far off the grid, so both the values
+        # and the mask read the zero cval there and the result becomes NaN
+        lat_idx = np.where(np.isnan(lat_w), -1e6, lat_i0 + lat_w)
+        lon_idx = np.where(np.isnan(lon_w), -1e6, lon_i0 + lon_w)
+        coords = cp.asarray(np.stack(np.meshgrid(lat_idx, lon_idx, indexing='ij')), dtype=cp.float32)
+
+    def _interp_block_gpu(swe_block):
+        # Upload the chunk once and copy the result back once
+        d_swe = cp.asarray(swe_block)
+        d_upscaled = cp.empty(swe_block.shape[:-2] + out_shape, dtype=cp.float32)
+
+        for t in range(swe_block.shape[0]):
+            valid = ~cp.isnan(d_swe[t])
+            weighted_sum = cp_ndimage.map_coordinates(
+                cp.where(valid, d_swe[t], cp.float32(0)), coords, order=1, cval=0.0)
+            weight = cp_ndimage.map_coordinates(
+                valid.astype(cp.float32), coords, order=1, cval=0.0)
+            d_upscaled[t] = cp.where(weight > 0, weighted_sum / weight, cp.nan)
+
+        return cp.asnumpy(d_upscaled)
+
+    # Time steps are independent, so chunk along time and let dask run the
+    # interpolation of each chunk in parallel
+    SNODAS_SWE = SNODAS_SWE.chunk({'time': 1, 'lat': -1, 'lon': -1})
+
+    upscaled_swe_da = xr.apply_ufunc(
+        _interp_block_gpu if USE_GPU else _interp_block,
+        SNODAS_SWE['SWE'].astype(np.float32, copy=False),
+        input_core_dims=[['lat', 'lon']],
+        output_core_dims=[['latitude', 'longitude']],
+        dask='parallelized',
+        output_dtypes=[np.float32],
+        dask_gufunc_kwargs={
+            'output_sizes': {
+                'latitude': len(CaPA_lat_range),
+                'longitude': len(CaPA_lon_range)
+            }
+        }
     )
 
+    upscaled_swe_da = upscaled_swe_da.assign_coords(
+        latitude=CaPA_lat_range,
+        longitude=CaPA_lon_range
+    ).rename('swe_upscaled')
+
     upscaled_snodas = xr.Dataset({'swe_upscaled': upscaled_swe_da})
 
     return upscaled_snodas, CaPA
@@ -5,12 +5,17 @@ import os
 import tarfile
 import gzip
 import shutil
+import multiprocessing
 from pathlib import Path
-import subprocess
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
 from datetime import datetime
 from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import zarr
+from zarr.codecs import BloscCodec
 #from snodas_postprocess import run_postprocessing
 
 # Get current date
@@ -27,20 +32,142 @@ BASE_URL = f"https://noaadata.apps.nsidc.org/NOAA/G02158/unmasked/{year}/{month_
 SCRIPT_DIR = Path(__file__).parent.absolute()
 DOWNLOAD_DIR = SCRIPT_DIR / "snodas_data"
 
+# Raw SNODAS grid: 8192 x 4096 big-endian int16 cells, bounded by its outer edges
+SNODAS_NROWS, SNODAS_NCOLS = 4096, 8192
+SNODAS_BOUNDS = [-130.51666666666667, 58.23333333333333, -62.25000000000000, 24.10000000000000]  # ulx, uly, lrx, lry
+SNODAS_NODATA = -9999
+
+# Define area of interest
+AREA_ALBERTA_EXTENDED = [63.5, -129, 46, -101]  # Alberta, Saskatchewan, BC
+
+# Maximum number of simultaneous downloads from the server
+MAX_CONCURRENT_DOWNLOADS = 8
+
+# Files of at least MIN_RANGED_DOWNLOAD_SIZE bytes are fetched as DOWNLOAD_PARTS
+# parallel byte ranges when the server supports range requests
+DOWNLOAD_PARTS = 4
+MIN_RANGED_DOWNLOAD_SIZE = 16 * 1024 * 1024
+
+# One session for the listing and all downloads, so connections to the server are
+# kept alive and reused instead of opening a new TCP/TLS connection per request
+_SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=MAX_CONCURRENT_DOWNLOADS * DOWNLOAD_PARTS,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504))
+)
+_SESSION.mount('https://', _adapter)
+_SESSION.mount('http://', _adapter)
+
 # Create local download folder if not exists
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
 def get_file_list():
     """Scrape list of files on the server."""
     #headers = {'User-Agent': 'Mozilla/5.0'}
-    response = requests.get(BASE_URL)  # , headers=headers)
+    response = _SESSION.get(BASE_URL)  # , headers=headers)
     #if response.status_code != 200:
         #raise Exception(f"Failed to fetch file list from {BASE_URL}. Status code: {response.status_code}")
     soup = BeautifulSoup(response.text, 'html.parser')
     return [a['href'] for a in soup.find_all('a') if a['href'].endswith('.tar')]
 
+def _extract(tar_file_path, temp_dir):
+    """Extract a SNODAS tar file and keep only the SWE and SD files."""
+    with tarfile.open(tar_file_path) as tar:
+        tar.extractall(path=temp_dir)
+
+    # Keep only selected files (5th to 8th)
+    files = sorted(os.listdir(temp_dir))
+    if len(files) >= 8:
+        keep_files = files[4:8]
+        for file in files:
+            if file not in keep_files:
+                os.remove(temp_dir / file)
+
+def _gunzip(gz_file):
+    """Decompress a single .gz file next to it and remove the archive."""
+    with gzip.open(gz_file, 'rb') as f_in:
+        with open(gz_file.with_suffix(''), 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+    os.remove(gz_file)
+
+def _gunzip_dir(temp_dir, executor):
+    """Decompress all .dat.gz grids in a directory concurrently."""
+    list(executor.map(_gunzip, temp_dir.glob("*.dat.gz")))
+
+def _read_dat(dat_file):
+    """
+    Read a raw SNODAS .dat grid, crop it to the area of interest and return it
+    as a single-day dataset with the SWE (mm) or SD (m) variable.
+    """
+    # Extract date and variable from filename
+    date_part = dat_file.stem.split("NATS")[-1][:8]
+    var_type = "SWE" if "1034" in dat_file.name else "SD" if "1036" in dat_file.name else None
+    if var_type is None:
+        return None
+
+    # Cell-centre coordinates of the full grid (rows run north to south)
+    ulx, uly, lrx, lry = SNODAS_BOUNDS
+    lon = ulx + (np.arange(SNODAS_NCOLS) + 0.5) * (lrx - ulx) / SNODAS_NCOLS
+    lat = uly - (np.arange(SNODAS_NROWS) + 0.5) * (uly - lry) / SNODAS_NROWS
+
+    # Index ranges of the area of interest
+    north, west, south, east = AREA_ALBERTA_EXTENDED
+    rows = np.flatnonzero((lat >= south) & (lat <= north))
+    cols = np.flatnonzero((lon >= west) & (lon <= east))
+    rows = slice(rows[0], rows[-1] + 1)
+    cols = slice(cols[0], cols[-1] + 1)
+
+    # Map the raw file and copy only the cropped cells, flipped to ascending latitude
+    raw = np.memmap(dat_file, dtype='>i2', mode='r', shape=(SNODAS_NROWS, SNODAS_NCOLS))
+    data = raw[rows, cols][::-1].astype(np.float32)
+    del raw
+    data[data == SNODAS_NODATA] = np.nan
+
+    if var_type == "SWE":
+        units = 'mm'
+    else:
+        data /= 1000
+        units = 'm'
+
+    time_index = pd.to_datetime(date_part, format="%Y%m%d")
+    return xr.Dataset(
+        data_vars={var_type: (("time", "lat", "lon"), data[np.newaxis], {"units": units})},
+        coords={
+            "time": [time_index],
+            "lat": lat[rows][::-1],
+            "lon": lon[cols]
+        }
+    )
+
+def _convert_dat(dat_file, output_dir, log_file):
+    """Crop a single .dat file and stage it as <YYYYMMDD>_<SWE|SD>.nc in output_dir."""
+    print(f"Processing: {dat_file}")
+
+    try:
+        ds = _read_dat(dat_file)
+        if ds is None:
+            return False
+        var_type = list(ds.data_vars)[0]
+        ds.to_netcdf(output_dir / f"{pd.Timestamp(ds.time.values[0]):%Y%m%d}_{var_type}.nc",
+                     engine='h5netcdf')
+    except Exception as e:
+        # Log failure
+        with open(log_file, 'a') as f:
+            f.write(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} | Failed to convert {dat_file}\n")
+        print(f"Error converting {dat_file}: {e}")
+        return False
+
+    # Log success
+    with open(log_file, 'a') as f:
+        f.write(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} | Converted {dat_file} -> {output_dir}\n")
+    return True
+
 def process_tar_file(tar_file_path):
-    """Process a SNODAS tar file and convert its contents to NetCDF format."""
+    """
+    Process a SNODAS tar file: read its SWE and SD grids, crop them to the area of
+    interest and stage them as NetCDF files in netcdf_output.
+    """
     if not tar_file_path:
         print("No .tar file provided.")
         return False
@@ -58,77 +185,20 @@ def process_tar_file(tar_file_path):
     temp_dir.mkdir(exist_ok=True)
 
     try:
-        # Extract contents
-        with tarfile.open(tar_file_path) as tar:
-            tar.extractall(path=temp_dir)
-
-        # Keep only selected files (5th to 8th)
-        files = sorted(os.listdir(temp_dir))
-        if len(files) >= 8:
-            keep_files = files[4:8]
-            for file in files:
-                if file not in keep_files:
-                    os.remove(temp_dir / file)
-            #for file in keep_files:
-                #shutil.move(temp_dir / file, Path(tar_file_path).parent)
-
-        # Unzip all .gz files in current directory
-        for gz_file in temp_dir.glob("*.gz"):
-            with gzip.open(gz_file, 'rb') as f_in:
-                with open(temp_dir / gz_file.stem, 'wb') as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-            os.remove(gz_file)
-
-        # Create .hdr files
-        for dat_file in temp_dir.glob("*.dat"):
-            header = dat_file.stem
-            hdr_file = (dat_file.with_suffix('.hdr'))
-            
-            with open(hdr_file, 'w') as f:
-                f.write("ENVI\nsamples = 8192\nlines = 4096\nbands = 1\nheader offset = 0\nfile type = ENVI Standard\ndata type = 2\ninterleave = bsq\nbyte order = 1\n")
-
-        # Convert to NetCDF and clean up
-        for dat_file in temp_dir.glob("*.dat"):
-            # Extract date part from filename
-            date_part = dat_file.stem.split("ssmv1")[-1].split("05HP001")[0]
-            output_file = temp_dir / f"output_{date_part}.nc"
-
-            print(f"Processing: {dat_file} → {output_file}")
-
-            # Set GDAL_DATA environment variable
-            os.environ['GDAL_DATA'] = r"C:\_LOCALdata\Anaconda\envs\forecast\Library\share\gdal"
-
-            # Define the path to gdal_translate
-            GDAL_TRANSLATE = r"C:\_LOCALdata\Anaconda\envs\forecast\Library\bin\gdal_translate.exe"
-
-            # Then your subprocess.run call remains the same
-            result = subprocess.run([
-                GDAL_TRANSLATE,
-                "-of", "NetCDF",
-                "-a_srs", "+proj=longlat +ellps=WGS84 +datum=WGS84 +no_defs",
-                "-a_nodata", "-9999",
-                "-a_ullr", "-130.51666666666667", "58.23333333333333", "-62.25000000000000", "24.10000000000000",
-                str(dat_file),
-                str(output_file)
-            ], capture_output=True, text=True)
-
-            if result.returncode == 0:
-                # Log success
-                with open(log_file, 'a') as f:
-                    f.write(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} | Converted {dat_file} -> {output_dir}\n")
-                
-                # Move output file to netcdf_output directory
-                shutil.move(output_file, output_dir / output_file.name)
-
-                # Cleanup
-                os.remove(dat_file)
-                os.remove(dat_file.with_suffix('.hdr'))
-                os.remove(dat_file.with_suffix('.txt'))
-            else:
-                # Log failure
-                with open(log_file, 'a') as f:
-                    f.write(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} | Failed to convert {dat_file}\n")
-                print(f"Error converting {dat_file}: {result.stderr}")
+        _extract(tar_file_path, temp_dir)
+
+        # gzip decompression and file I/O release the GIL, so the
+        # independent files of a tar are handled by a thread pool
+        with ThreadPoolExecutor() as executor:
+            _gunzip_dir(temp_dir, executor)
+
+            # Crop the raw grids and stage them as NetCDF
+            futures = [
+                executor.submit(_convert_dat, dat_file, output_dir, log_file)
+                for dat_file in temp_dir.glob("*.dat")
+            ]
+            for future in as_completed(futures):
+                future.result()
 
         return True
 
@@ -140,63 +210,165 @@ def process_tar_file(tar_file_path):
         if temp_dir.exists():
             shutil.rmtree(temp_dir)
 
-def run_postprocessing():
+def _zarr_encoding(var_type):
+    """
+    Chunking, compression and storage type used for the SNODAS Zarr archive stores.
+    Values are stored as int16 like the raw SNODAS grids (SD in mm, read back in m).
+    """
+    encoding = {
+        'chunks': (31, 256, 256),
+        'compressors': (BloscCodec(cname='zstd', clevel=3, shuffle='bitshuffle'),),
+        'dtype': 'int16',
+        '_FillValue': SNODAS_NODATA
+    }
+    if var_type == "SD":
+        encoding['scale_factor'] = np.float32(0.001)
+    return {var_type: encoding}
+
+def _append_to_archive(ds, store_path, var_type):
     """
-    This function processes SNODAS NetCDF files, filtering them for a specific area,
-    renaming variables, and saving the cleaned datasets.
+    Append a dataset to a Zarr archive store along time, creating the store
+    (and converting any existing *_final.nc archive files) on first use.
+    Appends leave the consolidated metadata stale; call zarr.consolidate_metadata
+    on the store after appending.
     """
-    # Define area of interest
-    area_alberta_extended = [63.5, -129, 46, -101]  # Alberta, Saskatchewan, BC
+    if not os.path.exists(store_path):
+        # One-time conversion of the NetCDF archive into the new store
+        archive_dir = os.path.dirname(store_path)
+        legacy_files = sorted(
+            os.path.join(archive_dir, f)
+            for f in os.listdir(archive_dir)
+            if f.endswith(f"_{var_type}_final.nc")
+        )
+        if legacy_files:
+            with xr.open_mfdataset(legacy_files, combine='nested', concat_dim='time',
+                               engine='h5netcdf') as legacy:
+                legacy = legacy.chunk({'time': 31, 'lat': 256, 'lon': 256})
+                legacy.to_zarr(store_path, mode='w-', consolidated=True,
+                               encoding=_zarr_encoding(var_type))
+        else:
+            ds.to_zarr(store_path, mode='w-', consolidated=True,
+                       encoding=_zarr_encoding(var_type))
+            return
+
+    # Skip dates that are already archived
+    with xr.open_zarr(store_path, consolidated=False) as archived:
+        ds = ds.sel(time=~ds['time'].isin(archived['time'].values))
+    if ds.sizes['time'] == 0:
+        return
+
+    ds.to_zarr(store_path, mode='a', append_dim='time', consolidated=False)
 
-    # Set folder path
+def run_postprocessing():
+    """
+    This function appends the cropped daily SNODAS datasets staged in netcdf_output
+    by process_tar_file to the Zarr archive (Archive/SNODAS_SWE.zarr and
+    Archive/SNODAS_SD.zarr).
+
+    Returns:
+    --------
+    list of str
+        Paths of the archive stores that were written to
+    """
+    # Set folder paths
     script_dir = os.path.dirname(os.path.abspath(__file__))
     folder_path_SNODAS = os.path.join(script_dir, "netcdf_output")
+    archive_dir = os.path.join(script_dir, "Archive")
+    os.makedirs(archive_dir, exist_ok=True)
 
-    # Get list of NetCDF files excluding final ones
-    nc_files_SNODAS = sorted([
-        os.path.join(folder_path_SNODAS, f)
-        for f in os.listdir(folder_path_SNODAS)
-        if not f.endswith("Alberta.nc")
-    ])
-
-    # Prepare cleaned names
-    cleaned_names = []
-    for fpath in nc_files_SNODAS:
-        fname = os.path.basename(fpath)
-        date_part = fname.split("NATS")[-1].split(".")[0]
-        var_type = "SWE" if "1034" in fname else "SD" if "1036" in fname else "UNKNOWN"
-        cleaned_names.append((fpath, f"{date_part}_{var_type}", var_type, date_part))
-
-    # Process each file
-    for fpath, new_name, var_type, date_part in cleaned_names:
-        with xr.open_dataset(fpath) as ds:
-            ds_filtered = ds.where(
-                (ds['lon'] >= area_alberta_extended[1]) & (ds['lon'] <= area_alberta_extended[3]) &
-                (ds['lat'] >= area_alberta_extended[2]),
-                drop=True
-            )
-
-            time_index = pd.to_datetime(date_part, format="%Y%m%d")
-            ds_time = ds_filtered.expand_dims(dim={"time": [time_index]})
-            ds_dropped = ds_time.drop_vars('crs', errors='ignore')
-
-            if var_type == "SWE":
-                ds_final = ds_dropped.rename({'Band1': 'SWE'})
-                ds_final['SWE'].attrs["units"] = 'mm'
-            elif var_type == "SD":
-                ds_final = ds_dropped.rename({'Band1': 'SD'})
-                ds_final['SD'] = ds_final['SD'] / 1000
-                ds_final['SD'].attrs['units'] = 'm'
-            else:
-                continue
-            # Save the final dataset
-            ds_final.to_netcdf(os.path.join(folder_path_SNODAS, new_name + "_final.nc"))
+    # Staged files are named <YYYYMMDD>_<SWE|SD>.nc, so sorting keeps dates in order
+    nc_files_SNODAS = sorted(
+        f for f in os.listdir(folder_path_SNODAS)
+        if f.endswith(("_SWE.nc", "_SD.nc"))
+    )
+
+    # Group the staged days by variable
+    files_by_var = {}
+    for fname in nc_files_SNODAS:
+        var_type = fname.split("_")[1].split(".")[0]
+        files_by_var.setdefault(var_type, []).append(os.path.join(folder_path_SNODAS, fname))
+
+    # Append all new days of a variable to its archive store in a single write.
+    # The days are loaded into memory so the write is not split along the
+    # one-day chunks of the staged files
+    store_paths = []
+    for var_type, files in files_by_var.items():
+        store_path = os.path.join(archive_dir, f"SNODAS_{var_type}.zarr")
+        with xr.open_mfdataset(files, combine='nested', concat_dim='time',
+                               engine='h5netcdf') as ds_new:
+            _append_to_archive(ds_new.load(), store_path, var_type)
+        # Readers open the store with consolidated metadata, so refresh it
+        # right after the (single) append
+        zarr.consolidate_metadata(store_path)
+        store_paths.append(store_path)
+
+    return store_paths
         
-def download_new_files():
+def _download_range(file_url, local_path, start, end):
+    """Download bytes start..end (inclusive) of a file and write them at the same offset."""
+    with _SESSION.get(file_url, headers={'Range': f"bytes={start}-{end}"}, stream=True) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise IOError(f"Server ignored the range request for {file_url}")
+        with open(local_path, 'r+b') as f:
+            f.seek(start)
+            for chunk in r.iter_content(chunk_size=65536):
+                f.write(chunk)
+
+def _download_file(file):
+    """Download a single SNODAS tar file from the server into DOWNLOAD_DIR."""
+    file_url = urljoin(BASE_URL, file)
+    local_path = os.path.join(DOWNLOAD_DIR, file)
+    print(f"Downloading {file}...")
+    try:
+        head = _SESSION.head(file_url, allow_redirects=True)
+        head.raise_for_status()
+        size = int(head.headers.get('Content-Length', 0))
+
+        if head.headers.get('Accept-Ranges') == 'bytes' and size >= MIN_RANGED_DOWNLOAD_SIZE:
+            # Preallocate the file and fetch its byte ranges in parallel
+            with open(local_path, 'wb') as f:
+                f.truncate(size)
+            bounds = np.linspace(0, size, DOWNLOAD_PARTS + 1, dtype=np.int64)
+            with ThreadPoolExecutor(max_workers=DOWNLOAD_PARTS) as executor:
+                futures = [
+                    executor.submit(_download_range, file_url, local_path, start, end - 1)
+                    for start, end in zip(bounds[:-1], bounds[1:])
+                ]
+                for future in futures:
+                    future.result()
+        else:
+            # Single stream for small files or servers without range support
+            with _SESSION.get(file_url, stream=True) as r:
+                r.raise_for_status()
+                with open(local_path, 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=65536):
+                        f.write(chunk)
+    except Exception:
+        # Do not leave a partial file behind, it would be skipped on the next run
+        if os.path.exists(local_path):
+            os.remove(local_path)
+        raise
+    print(f"Downloaded: {file}")
+    return local_path
+
+def download_new_files(max_workers=MAX_CONCURRENT_DOWNLOADS, process_workers=None):
+    """
+    Download the SNODAS tar files that are on the server but not yet in DOWNLOAD_DIR,
+    process them into the Zarr archive and clean up the staged files.
+
+    Parameters:
+    -----------
+    max_workers : int
+        Number of files downloaded at the same time
+    process_workers : int, optional
+        Number of processes extracting and converting the tar files. If None,
+        one per CPU
+    """
     print(f"[{datetime.now()}] Checking for new SNODAS files...")
 
     files_online = get_file_list()
-    files_local = os.listdir(DOWNLOAD_DIR)
+    files_local = set(os.listdir(DOWNLOAD_DIR))
 
     new_files = [f for f in files_online if f not in files_local]
 
@@ -204,24 +376,36 @@ def download_new_files():
         print("No new files found.")
         return
     
-    for file in new_files:
-        file_url = urljoin(BASE_URL, file)
-        local_path = os.path.join(DOWNLOAD_DIR, file)
-        print(f"Downloading {file}...")
-        with requests.get(file_url, stream=True) as r:
-            with open(local_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
-        print(f"Downloaded: {file}")
-
-        # Process the downloaded file
-        try:
-            if process_tar_file(local_path):
-                print(f"Processed: {file}")
-            else:
-                print(f"Processing failed for {file}")
-        except Exception as e:
-            print(f"Processing failed for {file}: {e}")
+    # Download several files at once and hand each tar to a process pool as soon
+    # as it is on disk, so processing overlaps with the remaining downloads. The
+    # workers are started while the download threads are running, so they come
+    # from a fork server instead of being forked from this multi-threaded process
+    # (a forked child can inherit locks held by the other threads and deadlock)
+    with ThreadPoolExecutor(max_workers=max_workers) as download_pool, \
+            ProcessPoolExecutor(max_workers=process_workers,
+                                mp_context=multiprocessing.get_context('forkserver')) as process_pool:
+        downloads = {download_pool.submit(_download_file, file): file for file in new_files}
+        processing = {}
+
+        for future in as_completed(downloads):
+            file = downloads[future]
+            try:
+                local_path = future.result()
+            except Exception as e:
+                print(f"Download failed for {file}: {e}")
+                continue
+            processing[process_pool.submit(process_tar_file, local_path)] = file
+
+        # Wait for the processing of the downloaded files
+        for future in as_completed(processing):
+            file = processing[future]
+            try:
+                if future.result():
+                    print(f"Processed: {file}")
+                else:
+                    print(f"Processing failed for {file}")
+            except Exception as e:
+                print(f"Processing failed for {file}: {e}")
 
     # Run the postprocessing script
     run_postprocessing()
@@ -229,29 +413,17 @@ def download_new_files():
     print("All new files downloaded and processed.")
 
 
-    ### ARCHIVE FINAL FILES AND CLEANUP ###
+    ### CLEANUP ###
     output_dir = os.path.join(os.path.dirname(__file__), "netcdf_output")
-    archive_dir = os.path.join(os.path.dirname(__file__), "Archive")
-
-    os.makedirs(archive_dir, exist_ok=True)
 
-    for filename in os.listdir(output_dir):
-        file_path = os.path.join(output_dir, filename)
-
-        # Move only SWE/SD .final files to Archive
-        if filename.endswith("final.nc") and ("SWE" in filename or "SD" in filename):
-            archive_path = os.path.join(archive_dir, filename)
-            os.rename(file_path, archive_path)
-            print(f"Archived: {filename}")
-
-    # Now clear the rest of the netcdf_output directory
-    for filename in os.listdir(output_dir):
-        file_path = os.path.join(output_dir, filename)
-        try:
-            os.remove(file_path)
-            print(f"Deleted: {filename}")
-        except Exception as e:
-            print(f"Failed to delete {filename}: {e}")
+    # Final datasets are already in the Zarr archive, so clear the netcdf_output directory
+    with os.scandir(output_dir) as entries:
+        for entry in entries:
+            try:
+                os.remove(entry.path)
+                print(f"Deleted: {entry.name}")
+            except Exception as e:
+                print(f"Failed to delete {entry.name}: {e}")
 
 
 
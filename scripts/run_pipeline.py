@@ -18,30 +18,143 @@ Date: 2024
 
 import sys
 import os
+import json
+import logging
 from pathlib import Path
-import xarray as xr
-import pandas as pd
 from datetime import datetime, timedelta
 
 # Add the parent directory to the path to import lwf_calc
 sys.path.append(str(Path(__file__).parent.parent))
 
-from lwf_calc import (
-    calculate_lwf,
-    resample_SNODAS_to_CaPA,
-    load_SNODAS,
-    load_CaPA,
-    download_new_files,
-    run_postprocessing
-)
+# xarray, dask, zarr and lwf_calc take seconds to import, so they are imported
+# inside the functions that use them and `--help` does not wait for them
 
-def main(start_date, end_date):
+logger = logging.getLogger("lwf")
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+def _set_xarray_options(xr):
+    """
+    The legacy SNODAS archive has one file per day; keep up to 512 of them open
+    (xarray's default is 128), so a season's worth of daily files is not closed
+    and reopened while the windows and the Step 8 statistics are read.
+    """
+    xr.set_options(file_cache_maxsize=512)
+
+def _netcdf_encoding(ds):
+    """
+    NetCDF encoding for the gridded output variables: one chunk per day of at most
+    512 x 512 cells, compressed with zlib and the shuffle filter.
+    """
+    encoding = {}
+    for name, var in ds.data_vars.items():
+        if var.ndim != 3:
+            continue
+        _, ny, nx = var.shape
+        encoding[name] = {
+            'chunksizes': (1, min(512, ny), min(512, nx)),
+            'zlib': True,
+            'complevel': 4,
+            'shuffle': True,
+            '_FillValue': -9999.0
+        }
+    return encoding
+
+def _zarr_encoding(ds):
+    """
+    Zarr encoding for the gridded output variables: one chunk per day of at most
+    512 x 512 cells, compressed with Blosc/zstd.
+    """
+    from zarr.codecs import BloscCodec
+
+    encoding = {}
+    for name, var in ds.data_vars.items():
+        if var.ndim != 3:
+            continue
+        _, ny, nx = var.shape
+        encoding[name] = {
+            'chunks': (1, min(512, ny), min(512, nx)),
+            'compressors': (BloscCodec(cname='zstd', clevel=3, shuffle='shuffle'),)
+        }
+    return encoding
+
+def _write_output(ds, path, output_format, append=False):
+    """
+    Set up the delayed write of an output dataset as a NetCDF file or a Zarr store.
+    With append=True the dataset is appended along time to an existing Zarr store.
+    """
+    if output_format == 'zarr':
+        # Each dask chunk must cover whole Zarr chunks, so the chunks can be
+        # written in parallel
+        ds = ds.chunk({'time': 1, 'latitude': 512, 'longitude': 512})
+        if append:
+            return ds.to_zarr(path, append_dim='time', compute=False)
+        return ds.to_zarr(path, mode='w', encoding=_zarr_encoding(ds), compute=False)
+    return ds.to_netcdf(path, engine='h5netcdf', invalid_netcdf=False,
+                        encoding=_netcdf_encoding(ds), compute=False)
+
+def _open_output(paths, output_format):
+    """Lazily open the written output files (or Zarr store) of one result."""
+    import xarray as xr
+
+    if output_format == 'zarr':
+        return xr.open_zarr(paths[0])
+    return xr.open_mfdataset(paths, engine='h5netcdf', combine='by_coords')
+
+def _date_windows(start, end, days=None):
+    """
+    Split the period [start, end] (datetime objects) into consecutive windows of
+    at most `days` days, as (window_start, window_end) pairs. With days=None the
+    whole period is a single window.
+    """
+    if days is None:
+        return [(start, end)]
+    if days < 2:
+        # The first window needs two days for at least one LWF value
+        raise ValueError("Windows must be at least 2 days long")
+
+    windows = []
+    window_start = start
+    while window_start <= end:
+        window_end = min(window_start + timedelta(days=days - 1), end)
+        windows.append((window_start, window_end))
+        window_start = window_end + timedelta(days=1)
+    return windows
+
+def main(start_date, end_date, output_format='netcdf', download_workers=8, window_days=None):
     """
     Main pipeline function that demonstrates the complete LWF calculation workflow.
+    
+    Parameters:
+    -----------
+    start_date : str
+        Start date in 'YYYY-MM-DD' format
+    end_date : str
+        End date in 'YYYY-MM-DD' format
+    output_format : str
+        Format of the Step 7 outputs, either 'netcdf' (.nc files) or 'zarr' (.zarr stores)
+    download_workers : int
+        Number of SNODAS files downloaded at the same time in Step 1
+    window_days : int, optional
+        Process the period in windows of this many days (Steps 2-7), so memory use
+        is bounded by one window. Zarr outputs are appended window by window, NetCDF
+        outputs are written as one file per window. If None, the whole period is
+        processed at once
     """
-    print("=" * 60)
-    print("Liquid Water Flux (LWF) Calculation Pipeline")
-    print("=" * 60)
+    import xarray as xr
+    import dask
+    from dask.diagnostics import ProgressBar
+    from lwf_calc import (
+        calculate_lwf,
+        resample_SNODAS_to_CaPA,
+        load_SNODAS,
+        load_CaPA,
+        download_new_files
+    )
+    _set_xarray_options(xr)
+
+    logger.info("=" * 60)
+    logger.info("Liquid Water Flux (LWF) Calculation Pipeline")
+    logger.info("=" * 60)
     
     # Configuration - use the command line arguments if provided, otherwise use the default values
     if start_date is None:
@@ -53,122 +166,168 @@ def main(start_date, end_date):
     output_dir = script_dir.parent / "output"
     output_dir.mkdir(exist_ok=True)
     
-    print(f"Processing period: {start_date} to {end_date}")
-    print(f"Output directory: {output_dir.absolute()}")
-    print()
+    # Parse the dates once; the loaders take the datetime objects directly and
+    # the output file names use the same tag
+    start = datetime.strptime(start_date, '%Y-%m-%d')
+    end = datetime.strptime(end_date, '%Y-%m-%d')
+    period_tag = f"{start:%Y-%m-%d}_{end:%Y-%m-%d}"
+    
+    logger.info(f"Processing period: {start_date} to {end_date}")
+    logger.info(f"Output directory: {output_dir.absolute()}")
     
     try:
         # Step 1: Check for new SNODAS files and download if needed and run post-processing
-        print("Step 1: Checking for new SNODAS files...")
-        download_new_files()
-        print("✓ SNODAS file check completed")
-        print()
+        logger.info("Step 1: Checking for new SNODAS files...")
+        download_new_files(max_workers=download_workers)
+        logger.info("✓ SNODAS file check completed")
 
-        # Step 2: Load SNODAS data
-        print("Step 2: Loading SNODAS SWE data...")
-        try:
-            snodas_swe = load_SNODAS(start_date, end_date, variable='SWE')
-            print(f"✓ Loaded SNODAS SWE data: {snodas_swe.dims}")
-            print(f"  Time range: {snodas_swe.time.min().values} to {snodas_swe.time.max().values}")
-        except Exception as e:
-            print(f"✗ Error loading SNODAS data: {e}")
-            print("  Make sure SNODAS data files exist in the Archive directory")
-            return
-        print()
-        
-        # Step 4: Load CaPA data
-        print("Step 4: Loading CaPA precipitation data...")
-        try:
-            capa_data = load_CaPA(start_date, end_date)
-            print(f"✓ Loaded CaPA data: {capa_data.dims}")
-            print(f"  Time range: {capa_data.time.min().values} to {capa_data.time.max().values}")
-        except Exception as e:
-            print(f"✗ Error loading CaPA data: {e}")
-            print("  Make sure CaPA data files exist in the Archive_CaPA directory")
-            return
-        print()
-        
-        # Step 5: Resample SNODAS to CaPA grid
-        print("Step 5: Resampling SNODAS to CaPA grid...")
-        try:
-            snodas_resampled, capa_cropped = resample_SNODAS_to_CaPA(snodas_swe, capa_data)
-            print(f"✓ Resampling completed")
-            print(f"  Resampled SNODAS shape: {snodas_resampled.swe_upscaled.shape}")
-            print(f"  Cropped CaPA shape: {capa_cropped.accum_precip.shape}")
-        except Exception as e:
-            print(f"✗ Error during resampling: {e}")
-            return
-        print()
-        
-        # Step 6: Calculate Liquid Water Flux
-        print("Step 6: Calculating Liquid Water Flux...")
-        try:
-            lwf_m_s, lwf_mm_day = calculate_lwf(snodas_resampled, capa_cropped)
-            print(f"✓ LWF calculation completed")
-            print(f"  LWF (m/s) shape: {lwf_m_s.lwf.shape}")
-            print(f"  LWF (mm/day) shape: {lwf_mm_day.lwf.shape}")
-        except Exception as e:
-            print(f"✗ Error calculating LWF: {e}")
-            return
-        print()
-        
-        # Step 7: Save results
-        print("Step 7: Saving results...")
-        try:
-            # Save LWF results
-            lwf_m_s.to_netcdf(output_dir / f"lwf_m_s_{start_date}_{end_date}.nc")
-            lwf_mm_day.to_netcdf(output_dir / f"lwf_mm_day_{start_date}_{end_date}.nc")
+        windows = _date_windows(start, end, window_days)
+        suffix = ".zarr" if output_format == "zarr" else ".nc"
+        lwf_paths = {'m_s': [], 'mm_day': []}
+
+        for i, (window_start, window_end) in enumerate(windows):
+            if len(windows) > 1:
+                logger.info(f"--- Window {i + 1}/{len(windows)}: {window_start:%Y-%m-%d} to {window_end:%Y-%m-%d} ---")
+
+            # LWF(t) needs SWE(t-1), so windows after the first also load the day
+            # before the window
+            load_start = window_start - timedelta(days=1) if i > 0 else window_start
+
+            # Step 2: Load SNODAS data
+            logger.info("Step 2: Loading SNODAS SWE data...")
+            try:
+                snodas_swe = load_SNODAS(load_start, window_end, variable='SWE')
+                # float32 is ample for SWE in mm and halves the data moved downstream
+                snodas_swe['SWE'] = snodas_swe['SWE'].astype('float32', copy=False)
+                logger.info(f"✓ Loaded SNODAS SWE data: {snodas_swe.dims}")
+                logger.info(f"  Time range: {snodas_swe.time.min().values} to {snodas_swe.time.max().values}")
+            except Exception as e:
+                logger.error(f"✗ Error loading SNODAS data: {e}")
+                logger.error("  Make sure SNODAS data files exist in the Archive directory")
+                return
             
-            # Save intermediate results for debugging
-            snodas_resampled.to_netcdf(output_dir / f"snodas_resampled_{start_date}_{end_date}.nc")
-            capa_cropped.to_netcdf(output_dir / f"capa_cropped_{start_date}_{end_date}.nc")
+            # Step 4: Load CaPA data
+            logger.info("Step 4: Loading CaPA precipitation data...")
+            try:
+                capa_data = load_CaPA(load_start, window_end)
+                capa_data['accum_precip'] = capa_data['accum_precip'].astype('float32', copy=False)
+                logger.info(f"✓ Loaded CaPA data: {capa_data.dims}")
+                logger.info(f"  Time range: {capa_data.time.min().values} to {capa_data.time.max().values}")
+            except Exception as e:
+                logger.error(f"✗ Error loading CaPA data: {e}")
+                logger.error("  Make sure CaPA data files exist in the Archive_CaPA directory")
+                return
             
-            print(f"✓ Results saved to {output_dir}")
-            print(f"  - lwf_m_s_{start_date}_{end_date}.nc")
-            print(f"  - lwf_mm_day_{start_date}_{end_date}.nc")
-            print(f"  - snodas_resampled_{start_date}_{end_date}.nc")
-            print(f"  - capa_cropped_{start_date}_{end_date}.nc")
-        except Exception as e:
-            print(f"✗ Error saving results: {e}")
-            return
-        print()
+            # Step 5: Resample SNODAS to CaPA grid
+            # The loaded data is dask-backed; resampling and the LWF stay lazy, so
+            # reading, resampling and the LWF are only computed when Step 7 writes them
+            logger.info("Step 5: Resampling SNODAS to CaPA grid...")
+            try:
+                snodas_resampled, capa_cropped = resample_SNODAS_to_CaPA(
+                    snodas_swe, capa_data, cache_dir=output_dir / ".cache"
+                )
+                logger.info(f"✓ Resampling completed")
+                logger.info(f"  Resampled SNODAS shape: {snodas_resampled.swe_upscaled.shape}")
+                logger.info(f"  Cropped CaPA shape: {capa_cropped.accum_precip.shape}")
+            except Exception as e:
+                logger.error(f"✗ Error during resampling: {e}")
+                return
+            
+            # Step 6: Calculate Liquid Water Flux
+            logger.info("Step 6: Calculating Liquid Water Flux...")
+            try:
+                lwf_m_s, lwf_mm_day = calculate_lwf(snodas_resampled, capa_cropped)
+                logger.info(f"✓ LWF calculation completed")
+                logger.info(f"  LWF (m/s) shape: {lwf_m_s.lwf.shape}")
+                logger.info(f"  LWF (mm/day) shape: {lwf_mm_day.lwf.shape}")
+            except Exception as e:
+                logger.error(f"✗ Error calculating LWF: {e}")
+                return
+            
+            # Step 7: Save results
+            logger.info("Step 7: Saving results...")
+            try:
+                # The day loaded before the window belongs to the previous window
+                snodas_resampled = snodas_resampled.sel(time=slice(window_start, None))
+                capa_cropped = capa_cropped.sel(time=slice(window_start, None))
+
+                # Zarr stores cover the whole period and are appended to; NetCDF
+                # files are written per window
+                if output_format == "zarr" or len(windows) == 1:
+                    tag = period_tag
+                else:
+                    tag = f"{window_start:%Y-%m-%d}_{window_end:%Y-%m-%d}"
+                append = output_format == "zarr" and i > 0
+
+                # Set up the writes of the LWF results and of the intermediate results
+                # (for debugging), chunked per day and compressed
+                outputs = {
+                    f"lwf_m_s_{tag}{suffix}": lwf_m_s,
+                    f"lwf_mm_day_{tag}{suffix}": lwf_mm_day,
+                    f"snodas_resampled_{tag}{suffix}": snodas_resampled,
+                    f"capa_cropped_{tag}{suffix}": capa_cropped
+                }
+                writes = [
+                    _write_output(ds, output_dir / fname, output_format, append=append)
+                    for fname, ds in outputs.items()
+                ]
+                
+                # Run all writes as one dask computation, so the shared reading and
+                # resampling are computed once and streamed to every file
+                with ProgressBar():
+                    dask.compute(*writes)
+                
+                if not append:
+                    lwf_paths['m_s'].append(output_dir / f"lwf_m_s_{tag}{suffix}")
+                    lwf_paths['mm_day'].append(output_dir / f"lwf_mm_day_{tag}{suffix}")
+                
+                logger.info(f"✓ Results saved to {output_dir}")
+                for fname in outputs:
+                    logger.info(f"  - {fname}")
+            except Exception as e:
+                logger.error(f"✗ Error saving results: {e}")
+                return
         
         # Step 8: Generate summary statistics
-        print("Step 8: Generating summary statistics...")
+        logger.info("Step 8: Generating summary statistics...")
         try:
-            # Calculate basic statistics
-            lwf_stats = {
-                'mean_m_s': float(lwf_m_s.lwf.mean()),
-                'max_m_s': float(lwf_m_s.lwf.max()),
-                'min_m_s': float(lwf_m_s.lwf.min()),
-                'std_m_s': float(lwf_m_s.lwf.std()),
-                'mean_mm_day': float(lwf_mm_day.lwf.mean()),
-                'max_mm_day': float(lwf_mm_day.lwf.max()),
-                'min_mm_day': float(lwf_mm_day.lwf.min()),
-                'std_mm_day': float(lwf_mm_day.lwf.std())
-            }
+            # Read the written LWF back lazily instead of recomputing it
+            lwf_m_s = _open_output(lwf_paths['m_s'], output_format)
+            lwf_mm_day = _open_output(lwf_paths['mm_day'], output_format)
             
-            # Save statistics to CSV
-            stats_df = pd.DataFrame([lwf_stats])
-            stats_df.to_csv(output_dir / f"lwf_statistics_{start_date}_{end_date}.csv", index=False)
+            # Calculate basic statistics, all in a single pass over the data
+            stats_ds = xr.Dataset({
+                'mean_m_s': lwf_m_s.lwf.mean(),
+                'max_m_s': lwf_m_s.lwf.max(),
+                'min_m_s': lwf_m_s.lwf.min(),
+                'std_m_s': lwf_m_s.lwf.std(),
+                'mean_mm_day': lwf_mm_day.lwf.mean(),
+                'max_mm_day': lwf_mm_day.lwf.max(),
+                'min_mm_day': lwf_mm_day.lwf.min(),
+                'std_mm_day': lwf_mm_day.lwf.std()
+            }).compute()
+            lwf_stats = {name: float(value) for name, value in stats_ds.data_vars.items()}
             
-            print("✓ Summary statistics:")
-            print(f"  LWF (m/s): mean={lwf_stats['mean_m_s']:.6f}, max={lwf_stats['max_m_s']:.6f}")
-            print(f"  LWF (mm/day): mean={lwf_stats['mean_mm_day']:.2f}, max={lwf_stats['max_mm_day']:.2f}")
-            print(f"  Statistics saved to: lwf_statistics_{start_date}_{end_date}.csv")
+            # Save statistics to JSON
+            with open(output_dir / f"lwf_statistics_{period_tag}.json", "w") as f:
+                json.dump(lwf_stats, f, indent=2)
+            
+            logger.info("✓ Summary statistics:")
+            logger.info(f"  LWF (m/s): mean={lwf_stats['mean_m_s']:.6f}, max={lwf_stats['max_m_s']:.6f}")
+            logger.info(f"  LWF (mm/day): mean={lwf_stats['mean_mm_day']:.2f}, max={lwf_stats['max_mm_day']:.2f}")
+            logger.info(f"  Statistics saved to: lwf_statistics_{period_tag}.json")
         except Exception as e:
-            print(f"✗ Error generating statistics: {e}")
-        print()
+            logger.error(f"✗ Error generating statistics: {e}")
         
-        print("=" * 60)
-        print("Pipeline completed successfully!")
-        print("=" * 60)
+        logger.info("=" * 60)
+        logger.info("Pipeline completed successfully!")
+        logger.info("=" * 60)
         
     except KeyboardInterrupt:
-        print("\nPipeline interrupted by user.")
+        logger.error("Pipeline interrupted by user.")
         sys.exit(1)
     except Exception as e:
-        print(f"\nPipeline failed with error: {e}")
+        logger.error(f"Pipeline failed with error: {e}")
         sys.exit(1)
 
 def run_single_location(lat, lon, start_date, end_date):
@@ -186,40 +345,46 @@ def run_single_location(lat, lon, start_date, end_date):
     end_date : str
         End date in 'YYYY-MM-DD' format
     """
-    print(f"Running pipeline for location: ({lat}, {lon})")
-    print(f"Period: {start_date} to {end_date}")
-    print()
+    import xarray as xr
+    from lwf_calc import calculate_lwf, load_SNODAS, load_CaPA
+    _set_xarray_options(xr)
+
+    logger.info(f"Running pipeline for location: ({lat}, {lon})")
+    logger.info(f"Period: {start_date} to {end_date}")
     
     try:
-        # Load data for specific location
-        snodas_swe = load_SNODAS(start_date, end_date, variable='SWE', lat=lat, lon=lon)
-        capa_data = load_CaPA(start_date, end_date, lat=lat, lon=lon)
+        # Parse the dates once for both loaders
+        start = datetime.strptime(start_date, '%Y-%m-%d')
+        end = datetime.strptime(end_date, '%Y-%m-%d')
+        
+        # Load data for specific location (nearest grid cell of each dataset)
+        snodas_swe = load_SNODAS(start, end, variable='SWE', lat=lat, lon=lon)
+        capa_data = load_CaPA(start, end, lat=lat, lon=lon)
         
-        # Resample (for single location, this is mostly for consistency)
-        snodas_resampled, capa_cropped = resample_SNODAS_to_CaPA(snodas_swe, capa_data)
+        # Both are time series at the location, so no resampling is needed
+        snodas_point = xr.Dataset({'swe_upscaled': snodas_swe['SWE']})
         
         # Calculate LWF
-        lwf_m_s, lwf_mm_day = calculate_lwf(snodas_resampled, capa_cropped)
+        lwf_m_s, lwf_mm_day = calculate_lwf(snodas_point, capa_data)
         
-        # Create time series
-        time_series = pd.DataFrame({
-            'date': lwf_m_s.time.values,
-            'lwf_m_s': lwf_m_s.lwf.values.flatten(),
-            'lwf_mm_day': lwf_mm_day.lwf.values.flatten()
-        })
+        # Create time series (the scalar lat/lon coordinates are dropped)
+        time_series = xr.merge([
+            lwf_m_s.lwf.rename('lwf_m_s'),
+            lwf_mm_day.lwf.rename('lwf_mm_day')
+        ]).reset_coords(drop=True).to_dataframe().rename_axis('date').reset_index()
         
         # Save time series
-        output_file = f"lwf_timeseries_{lat}_{lon}_{start_date}_{end_date}.csv"
+        output_file = f"lwf_timeseries_{lat}_{lon}_{start:%Y-%m-%d}_{end:%Y-%m-%d}.csv"
         time_series.to_csv(output_file, index=False)
         
-        print(f"✓ Time series saved to: {output_file}")
-        print(f"  Number of data points: {len(time_series)}")
-        print(f"  Mean LWF (mm/day): {time_series['lwf_mm_day'].mean():.2f}")
+        logger.info(f"✓ Time series saved to: {output_file}")
+        logger.info(f"  Number of data points: {len(time_series)}")
+        logger.info(f"  Mean LWF (mm/day): {time_series['lwf_mm_day'].mean():.2f}")
         
         return time_series
         
     except Exception as e:
-        print(f"✗ Error processing single location: {e}")
+        logger.error(f"✗ Error processing single location: {e}")
         return None
 
 if __name__ == "__main__":
@@ -231,10 +396,17 @@ if __name__ == "__main__":
     parser.add_argument("--lat", type=float, help="Latitude for single location analysis")
     parser.add_argument("--lon", type=float, help="Longitude for single location analysis")
     parser.add_argument("--single-location", action="store_true", help="Run for single location only")
+    parser.add_argument("--format", choices=["netcdf", "zarr"], default="netcdf",
+                        help="Output format of the results (default: netcdf)")
+    parser.add_argument("--download-workers", type=int, default=8,
+                        help="Number of SNODAS files downloaded in parallel (default: 8)")
+    parser.add_argument("--window-days", type=int,
+                        help="Process the period in windows of this many days to bound memory use")
     
     args = parser.parse_args()
     
     if args.single_location and args.lat is not None and args.lon is not None:
         run_single_location(args.lat, args.lon, args.start_date, args.end_date)
     else:
-        main(start_date=args.start_date, end_date=args.end_date)
+        main(start_date=args.start_date, end_date=args.end_date, output_format=args.format,
+             download_workers=args.download_workers, window_days=args.window_days)
@@ -38,15 +38,12 @@ setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.8",
-        "Programming Language :: Python :: 3.9",
-        "Programming Language :: Python :: 3.10",
         "Programming Language :: Python :: 3.11",
         "Programming Language :: Python :: 3.12",
         "Topic :: Scientific/Engineering :: Hydrology",
         "Topic :: Scientific/Engineering :: Atmospheric Science",
     ],
-    python_requires=">=3.8",
+    python_requires=">=3.11",
     install_requires=read_requirements(),
     extras_require={
         "dev": [
@@ -62,6 +59,9 @@ setup(
             "numba>=0.56.0",
             "dask>=2022.1.0",
         ],
+        "gpu": [
+            "cupy>=12.0.0",
+        ],
     },
     entry_points={
         "console_scripts": [